@@ -1,12 +1,15 @@
-from flask import Flask, request, send_file, jsonify
+from flask import Flask, Response, request, send_file, jsonify, stream_with_context
 from kittentts import KittenTTS
 import soundfile as sf
 import io
 import os
-import tempfile
 from pydub import AudioSegment
 import logging
 import re
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 import numpy as np
 
 app = Flask(__name__)
@@ -23,97 +26,172 @@ except Exception as e:
     logger.error(f"Failed to load KittenTTS model: {e}")
     model = None
 
+# KittenTTS keeps voice embeddings in a lazily-read voices.npz archive, which
+# re-reads the voice from the zip on every generate call. Load them all once.
+if model is not None:
+    try:
+        voice_archive = model.model.voices
+        model.model.voices = {name: voice_archive[name] for name in voice_archive.files}
+        logger.info(f"Cached {len(model.model.voices)} voice embeddings")
+    except Exception as e:
+        logger.warning(f"Could not cache voice embeddings: {e}")
+
+# The espeak phonemizer backend is not thread-safe, so serialize it; ONNX
+# inference itself can still run concurrently across chunks.
+if model is not None:
+    try:
+        phonemizer_lock = threading.Lock()
+        phonemize = model.model.phonemizer.phonemize
+
+        def locked_phonemize(*args, **kwargs):
+            with phonemizer_lock:
+                return phonemize(*args, **kwargs)
+
+        model.model.phonemizer.phonemize = locked_phonemize
+    except Exception as e:
+        logger.warning(f"Could not guard the phonemizer with a lock: {e}")
+
+# Initialize a sentencizer-only spaCy pipeline (no downloaded model needed)
+try:
+    import spacy
+    nlp = spacy.blank("en")
+    nlp.add_pipe("sentencizer")
+    logger.info("spaCy sentencizer loaded successfully")
+except Exception as e:
+    logger.warning(f"Failed to load spaCy sentencizer, using regex splitting: {e}")
+    nlp = None
+
+# Pick the AAC encoder for mp4 output, preferring hardware encoders when ffmpeg has them
+# (AudioToolbox on macOS, MediaFoundation on Windows). MP3 encoding is CPU-only.
+AAC_ENCODERS = ['aac_at', 'aac_mf', 'libfdk_aac', 'aac']
+try:
+    ffmpeg_encoders = subprocess.run(
+        ['ffmpeg', '-hide_banner', '-encoders'], capture_output=True, text=True, check=True
+    ).stdout
+    available_encoders = {line.split()[1] for line in ffmpeg_encoders.splitlines() if len(line.split()) > 1}
+    aac_encoder = 'aac'
+    # A listed hardware encoder can still fail to open (no device, missing driver),
+    # so probe each candidate with a tiny encode and step down on failure
+    for name in (name for name in AAC_ENCODERS if name in available_encoders):
+        try:
+            subprocess.run(
+                ['ffmpeg', '-hide_banner', '-loglevel', 'error', '-f', 'lavfi', '-i', 'anullsrc=r=24000:cl=mono',
+                 '-t', '0.05', '-c:a', name, '-f', 'null', '-'],
+                capture_output=True, check=True, timeout=10
+            )
+        except Exception as e:
+            logger.warning(f"AAC encoder {name} failed a test encode, trying the next one: {e}")
+            continue
+        aac_encoder = name
+        break
+    logger.info(f"Using AAC encoder: {aac_encoder}")
+except Exception as e:
+    logger.warning(f"Could not list ffmpeg encoders, using native AAC encoder: {e}")
+    aac_encoder = 'aac'
+
+# ffmpeg output settings for the streamed formats (mp4 is fragmented so it can be written to a pipe)
+MP3_OUTPUT_ARGS = ['-c:a', 'libmp3lame', '-b:a', '192k', '-q:a', '0', '-f', 'mp3']
+MP4_OUTPUT_ARGS = ['-c:a', aac_encoder, '-b:a', '128k', '-movflags', 'frag_keyframe+empty_moov', '-f', 'mp4']
+
+# Number of idle ffmpeg processes kept ready per output format, so requests don't pay process start-up
+FFMPEG_SPARES = int(os.environ.get('FFMPEG_SPARES', 1))
+ffmpeg_spares = {}
+ffmpeg_spares_lock = threading.Lock()
+
 # Available voices from the KittenTTS documentation
 AVAILABLE_VOICES = [
     'expr-voice-2-m', 'expr-voice-2-f', 'expr-voice-3-m', 'expr-voice-3-f',
     'expr-voice-4-m', 'expr-voice-4-f', 'expr-voice-5-m', 'expr-voice-5-f'
 ]
 
+# Maximum number of concurrent model.generate calls across all requests in this
+# process. ONNX Runtime already uses several intra-op threads per call and gunicorn
+# runs more than one worker, so default to half the cores to avoid oversubscribing.
+MAX_INFERENCE_WORKERS = int(os.environ.get('TTS_MAX_WORKERS', max(1, (os.cpu_count() or 1) // 2)))
+inference_slots = threading.BoundedSemaphore(MAX_INFERENCE_WORKERS)
+
+# Sentence endings (.!?) followed by whitespace
+SENTENCE_BOUNDARY_RE = re.compile(r'(?<=[.!?])\s+')
+
 def split_into_sentences(text):
     """Split text into sentences using regex (fallback method)"""
-    # Split on sentence endings (.!?) followed by whitespace or end of string
-    sentences = re.split(r'(?<=[.!?])\s+', text.strip())
-    # Filter out empty sentences and clean up
-    sentences = [s.strip() for s in sentences if s.strip()]
-    return sentences
+    # Split on sentence boundaries, then drop empty sentences and clean up
+    return [s for s in (part.strip() for part in SENTENCE_BOUNDARY_RE.split(text.strip())) if s]
+
+def pack_sentences(sentences, max_chars=400, max_words=50):
+    """Greedily pack sentences into chunks within the length limits (one model call per chunk)"""
+    chunks = []
+    current_chunk = ""
+    
+    for sentence in sentences:
+        # Check if adding this sentence would exceed limits
+        if (len(current_chunk + sentence) > max_chars or 
+            len((current_chunk + sentence).split()) > max_words):
+            
+            if current_chunk:
+                chunks.append(current_chunk.strip())
+                current_chunk = sentence
+            else:
+                # Single sentence is too long, split by words
+                words = sentence.split()
+                temp_chunk = ""
+                for word in words:
+                    if len(temp_chunk + word) <= max_chars and len(temp_chunk.split()) < max_words:
+                        temp_chunk += " " + word if temp_chunk else word
+                    else:
+                        if temp_chunk:
+                            chunks.append(temp_chunk.strip())
+                            temp_chunk = word
+                        else:
+                            chunks.append(word)
+                current_chunk = temp_chunk
+        else:
+            current_chunk += " " + sentence if current_chunk else sentence
+    
+    if current_chunk:
+        chunks.append(current_chunk.strip())
+    
+    return [chunk for chunk in chunks if chunk.strip()]
 
 def split_text_with_spacy(text, max_chars=400, max_words=50):
     """Split text using spaCy for better sentence detection with length limits"""
-    try:
-        import spacy
-        # Load spaCy model (will download if not available)
+    sentences = None
+    if nlp is not None:
         try:
-            nlp = spacy.load("en_core_web_sm")
-        except OSError:
-            logger.warning("spaCy English model not found. Installing...")
-            import subprocess
-            subprocess.run(["python", "-m", "spacy", "download", "en_core_web_sm"], check=True)
-            nlp = spacy.load("en_core_web_sm")
-        
-        doc = nlp(text)
-        sentences = [sent.text.strip() for sent in doc.sents]
-        
-        # Apply length limits to sentences
-        chunks = []
-        current_chunk = ""
-        
-        for sentence in sentences:
-            # Check if adding this sentence would exceed limits
-            if (len(current_chunk + sentence) > max_chars or 
-                len((current_chunk + sentence).split()) > max_words):
-                
-                if current_chunk:
-                    chunks.append(current_chunk.strip())
-                    current_chunk = sentence
-                else:
-                    # Single sentence is too long, split by words
-                    words = sentence.split()
-                    temp_chunk = ""
-                    for word in words:
-                        if len(temp_chunk + word) <= max_chars and len(temp_chunk.split()) < max_words:
-                            temp_chunk += " " + word if temp_chunk else word
-                        else:
-                            if temp_chunk:
-                                chunks.append(temp_chunk.strip())
-                                temp_chunk = word
-                            else:
-                                chunks.append(word)
-                    current_chunk = temp_chunk
-            else:
-                current_chunk += " " + sentence if current_chunk else sentence
-        
-        if current_chunk:
-            chunks.append(current_chunk.strip())
-        
-        return [chunk for chunk in chunks if chunk.strip()]
-        
-    except Exception as e:
-        logger.warning(f"spaCy failed, falling back to regex: {e}")
-        return split_into_sentences(text)
+            sentences = [sent.text.strip() for sent in nlp(text).sents]
+        except Exception as e:
+            logger.warning(f"spaCy failed, falling back to regex: {e}")
+    
+    if sentences is None:
+        sentences = split_into_sentences(text)
+    
+    return pack_sentences(sentences, max_chars, max_words)
 
 def generate_sentence_audio(sentence, voice):
     """Generate audio for a single sentence"""
     try:
-        audio = model.generate(sentence, voice=voice)
-        return audio
+        with inference_slots:
+            audio = model.generate(sentence, voice=voice)
+        # Convert once here; everything downstream works on contiguous 1-D float32 audio
+        return np.ascontiguousarray(np.squeeze(audio), dtype=np.float32)
     except Exception as e:
         logger.error(f"Error generating audio for sentence '{sentence[:30]}...': {e}")
         raise
 
+def peak_amplitude(audio_data):
+    """Return the largest absolute sample value without allocating an abs() copy"""
+    return max(float(audio_data.max()), -float(audio_data.min()))
+
 def normalize_audio(audio_data):
-    """Normalize audio to prevent clipping and improve quality"""
+    """Normalize audio in place to prevent clipping and improve quality"""
     if audio_data is None or len(audio_data) == 0:
         return audio_data
     
-    # Convert to float32 if needed
-    if audio_data.dtype != np.float32:
-        audio_data = audio_data.astype(np.float32)
-    
     # Normalize to prevent clipping
-    max_val = np.max(np.abs(audio_data))
+    max_val = peak_amplitude(audio_data)
     if max_val > 0:
         # Normalize to 0.95 to leave some headroom
-        audio_data = audio_data * (0.95 / max_val)
+        audio_data *= 0.95 / max_val
     
     return audio_data
 
@@ -122,27 +200,35 @@ def combine_audio_segments_simple(audio_segments, sample_rate=24000):
     if not audio_segments:
         raise ValueError("No audio segments to combine")
     
+    if len(audio_segments) == 1:
+        return audio_segments[0]
     
     # Calculate pause samples (150ms = 3600 samples at 24kHz for better separation)
     pause_samples = int(0.15 * sample_rate)
-    pause_audio = np.zeros((pause_samples,), dtype=np.float32)
 
-    
-    # Combine segments with pauses
-    combined = []
+    # Allocate the output once and copy each segment into place
+    total_samples = sum(len(segment) for segment in audio_segments) + (len(audio_segments) - 1) * pause_samples
+    final_audio = np.empty(total_samples, dtype=np.float32)
+
+    offset = 0
     for i, segment in enumerate(audio_segments):
-        segment = np.squeeze(segment).astype(np.float32)
-        segment = segment.astype(np.float32)
         if i > 0:
-            combined.append(pause_audio)
-        combined.append(segment)
-    
-    # Concatenate all segments
-    final_audio = np.concatenate(combined)
-    
-    
+            final_audio[offset:offset + pause_samples] = 0.0
+            offset += pause_samples
+        final_audio[offset:offset + len(segment)] = segment
+        offset += len(segment)
+
     return final_audio
 
+@lru_cache(maxsize=8)
+def fade_curves(fade_samples):
+    """Return (fade_in, fade_out) ramps of the given length, computed once and shared read-only"""
+    fade_in = np.linspace(0, 1, fade_samples, dtype=np.float32)
+    fade_out = fade_in[::-1].copy()
+    fade_in.flags.writeable = False
+    fade_out.flags.writeable = False
+    return fade_in, fade_out
+
 def combine_audio_segments_advanced(audio_segments, sample_rate=24000):
     """Advanced combination with crossfading and better audio processing"""
     if not audio_segments:
@@ -151,54 +237,38 @@ def combine_audio_segments_advanced(audio_segments, sample_rate=24000):
     if len(audio_segments) == 1:
         return normalize_audio(audio_segments[0])
     
-    # Normalize and prepare segments
-    normalized_segments = []
-    for segment in audio_segments:
-        if segment.dtype != np.float32:
-            segment = segment.astype(np.float32)
-        
-        # Apply gentle normalization
-        max_val = np.max(np.abs(segment))
-        if max_val > 0:
-            normalized_segment = segment * (0.85 / max_val)
-        else:
-            normalized_segment = segment
-        
-        normalized_segments.append(normalized_segment)
-    
     # Calculate pause with fade in/out for smoother transitions
     pause_samples = int(0.2 * sample_rate)  # 200ms pause
     fade_samples = int(0.01 * sample_rate)  # 10ms fade
+    fade_in, fade_out = fade_curves(fade_samples)
     
-    # Create pause with fade
-    pause_audio = np.zeros(pause_samples, dtype=np.float32)
+    # Allocate the output once; the pauses between segments stay silent
+    total_samples = sum(len(segment) for segment in audio_segments) + (len(audio_segments) - 1) * pause_samples
+    final_audio = np.zeros(total_samples, dtype=np.float32)
     
-    # Combine with crossfading
-    combined = []
-    for i, segment in enumerate(normalized_segments):
-        if i > 0:
-            # Add pause with fade
-            combined.append(pause_audio)
+    offset = 0
+    for segment in audio_segments:
+        length = len(segment)
+        output = final_audio[offset:offset + length]
         
-        # Apply fade in/out to segment
-        if len(segment) > 2 * fade_samples:
-            # Fade in
-            fade_in = np.linspace(0, 1, fade_samples)
-            segment[:fade_samples] *= fade_in
-            
-            # Fade out
-            fade_out = np.linspace(1, 0, fade_samples)
-            segment[-fade_samples:] *= fade_out
+        # Apply gentle normalization while copying into the output
+        max_val = peak_amplitude(segment)
+        if max_val > 0:
+            np.multiply(segment, 0.85 / max_val, out=output)
+        else:
+            output[:] = segment
         
-        combined.append(segment)
-    
-    # Concatenate all segments
-    final_audio = np.concatenate(combined)
+        # Apply fade in/out to the copied segment
+        if length > 2 * fade_samples:
+            output[:fade_samples] *= fade_in
+            output[-fade_samples:] *= fade_out
+        
+        offset += length + pause_samples
     
     # Final normalization
-    final_max = np.max(np.abs(final_audio))
+    final_max = peak_amplitude(final_audio)
     if final_max > 0:
-        final_audio = final_audio * (0.95 / final_max)
+        final_audio *= 0.95 / final_max
     
     return final_audio
 
@@ -216,35 +286,131 @@ def combine_audio_segments_pydub(audio_segments, sample_rate=24000):
         # Normalize the audio data
         audio_data = normalize_audio(audio_data)
         
-        # Create temporary WAV file for this segment
-        with tempfile.NamedTemporaryFile(suffix='.wav', delete=False) as temp_wav:
-            # Save as WAV with proper format
-            sf.write(temp_wav.name, audio_data, sample_rate, subtype='PCM_16')
-            
-            # Load as AudioSegment
-            segment = AudioSegment.from_wav(temp_wav.name)
-            
-            # Add small pause between sentences (100ms)
-            if i > 0:
-                pause = AudioSegment.silent(duration=100)
-                segment = pause + segment
-            
-            # Combine with previous segments
-            if combined_audio is None:
-                combined_audio = segment
+        # Build the segment directly from 16-bit PCM
+        pcm = (np.clip(audio_data, -1.0, 1.0) * 32767).astype('<i2').tobytes()
+        segment = AudioSegment(data=pcm, sample_width=2, frame_rate=sample_rate, channels=1)
+        
+        # Add small pause between sentences (100ms)
+        if i > 0:
+            pause = AudioSegment.silent(duration=100, frame_rate=sample_rate)
+            segment = pause + segment
+        
+        # Combine with previous segments
+        if combined_audio is None:
+            combined_audio = segment
+        else:
+            combined_audio += segment
+    
+    # Convert back to numpy array
+    return np.frombuffer(combined_audio.raw_data, dtype='<i2').astype(np.float32) / 32768.0
+
+def encode_wav(audio_data, sample_rate=24000, subtype='PCM_16'):
+    """Encode audio as an in-memory WAV file, returning a buffer rewound to the start"""
+    buffer = io.BytesIO()
+    sf.write(buffer, audio_data, sample_rate, subtype=subtype, format='WAV')
+    buffer.seek(0)
+    return buffer
+
+def ffmpeg_command(output_args, sample_rate=24000):
+    """Build an ffmpeg command that reads float32 PCM on stdin and writes to stdout"""
+    return [
+        'ffmpeg', '-loglevel', 'error',
+        '-f', 'f32le', '-ar', str(sample_rate), '-ac', '1', '-i', 'pipe:0',
+        *output_args, 'pipe:1'
+    ]
+
+def spawn_ffmpeg(command):
+    """Start an ffmpeg process with all three standard streams piped"""
+    return subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+def discard_ffmpeg(process):
+    """Stop an ffmpeg process and close its pipes"""
+    if process.poll() is None:
+        process.kill()
+        process.wait()
+    for pipe in (process.stdin, process.stdout, process.stderr):
+        pipe.close()
+
+def replenish_ffmpeg_spares(command):
+    """Top up the idle ffmpeg processes for this command in a background thread"""
+    key = tuple(command)
+    
+    def replenish():
+        try:
+            while True:
+                with ffmpeg_spares_lock:
+                    if len(ffmpeg_spares.setdefault(key, [])) >= FFMPEG_SPARES:
+                        return
+                process = spawn_ffmpeg(command)
+                with ffmpeg_spares_lock:
+                    spares = ffmpeg_spares[key]
+                    if len(spares) < FFMPEG_SPARES:
+                        spares.append(process)
+                        continue
+                discard_ffmpeg(process)
+                return
+        except Exception as e:
+            logger.warning(f"Could not pre-spawn ffmpeg: {e}")
+    
+    if FFMPEG_SPARES > 0:
+        threading.Thread(target=replenish, daemon=True).start()
+
+def acquire_ffmpeg(command):
+    """Take an idle pre-spawned ffmpeg process for this command, spawning one if none is ready"""
+    process = None
+    with ffmpeg_spares_lock:
+        spares = ffmpeg_spares.get(tuple(command), [])
+        while spares and process is None:
+            candidate = spares.pop()
+            if candidate.poll() is None:
+                process = candidate
             else:
-                combined_audio += segment
-            
-            # Clean up temporary file
-            os.unlink(temp_wav.name)
+                discard_ffmpeg(candidate)
     
-    # Convert back to numpy array with proper format
-    with tempfile.NamedTemporaryFile(suffix='.wav', delete=False) as temp_wav:
-        # Export with high quality settings
-        combined_audio.export(temp_wav.name, format='wav', parameters=['-ar', str(sample_rate)])
-        audio_data, _ = sf.read(temp_wav.name)
-        os.unlink(temp_wav.name)
-        return audio_data
+    if process is None:
+        process = spawn_ffmpeg(command)
+    replenish_ffmpeg_spares(command)
+    return process
+
+def stream_with_ffmpeg(audio_data, output_args, sample_rate=24000, chunk_size=65536):
+    """Encode float32 PCM through an ffmpeg pipe, yielding encoded bytes as they are produced"""
+    pcm = np.ascontiguousarray(audio_data, dtype=np.float32).tobytes()
+    process = acquire_ffmpeg(ffmpeg_command(output_args, sample_rate))
+    
+    # Feed ffmpeg from a background thread so we can read its output concurrently
+    def feed_input():
+        try:
+            process.stdin.write(pcm)
+            process.stdin.close()
+        except (BrokenPipeError, ValueError):
+            # ffmpeg exited early or the stream was closed; the exit code is checked below
+            pass
+    
+    writer = threading.Thread(target=feed_input, daemon=True)
+    writer.start()
+    try:
+        while True:
+            data = process.stdout.read1(chunk_size)
+            if not data:
+                break
+            yield data
+        
+        writer.join()
+        if process.wait() != 0:
+            errors = process.stderr.read().decode(errors='replace').strip()
+            raise RuntimeError(f"ffmpeg failed: {errors}")
+    finally:
+        if process.poll() is None:
+            # Client went away mid-stream
+            process.kill()
+            process.wait()
+        writer.join()
+        process.stdout.close()
+        process.stderr.close()
+
+# Spawn spare encoders now so the first requests don't wait on ffmpeg start-up
+for spare_output_args in (MP3_OUTPUT_ARGS, MP4_OUTPUT_ARGS):
+    replenish_ffmpeg_spares(ffmpeg_command(spare_output_args))
 
 @app.route('/health', methods=['GET'])
 def health_check():
@@ -270,6 +436,7 @@ def generate_audio():
         max_chars = data.get('max_chars', 400)  # Configurable character limit
         max_words = data.get('max_words', 50)   # Configurable word limit
         output_format = data.get('format', 'mp3')  # Output format: mp3, wav, mp4
+        bits = data.get('bits', 16)  # WAV sample format: 16 (PCM) or 32 (float, no conversion)
         use_chunking = data.get('use_chunking', True)  # Enable/disable chunking
         combine_method = data.get('combine_method', 'simple')  # simple, advanced, pydub
         
@@ -290,11 +457,22 @@ def generate_audio():
                 'error': f'Invalid format. Supported formats: mp3, wav, mp4'
             }), 400
         
+        if bits not in [16, 32]:
+            return jsonify({
+                'error': f'Invalid bits. Supported values: 16, 32'
+            }), 400
+        
         if combine_method not in ['simple', 'advanced', 'pydub']:
             return jsonify({
                 'error': f'Invalid combine method. Supported methods: simple, advanced, pydub'
             }), 400
         
+        for name, value in (('max_chars', max_chars), ('max_words', max_words)):
+            if type(value) is not int or value < 1:
+                return jsonify({
+                    'error': f'Invalid {name}. Must be a positive integer'
+                }), 400
+        
         # Check if model is loaded
         if model is None:
             return jsonify({'error': 'TTS model not loaded'}), 500
@@ -302,23 +480,34 @@ def generate_audio():
         logger.info(f"Generating audio for text: '{text[:50]}...' with voice: {voice}, format: {output_format}, chunking: {use_chunking}, combine: {combine_method}")
         
         if use_chunking:
-            # Split text using spaCy with length limits
-            chunks = split_text_with_spacy(text, max_chars, max_words)
-            logger.info(f"Split text into {len(chunks)} chunks using spaCy")
+            if len(text) <= max_chars and len(text.split()) <= max_words:
+                # Text already fits in a single chunk, no need to split it
+                chunks = [text.strip()]
+                logger.info("Text fits in a single chunk, skipping sentence splitting")
+            else:
+                # Split text using spaCy with length limits
+                chunks = split_text_with_spacy(text, max_chars, max_words)
+                logger.info(f"Split text into {len(chunks)} chunks using spaCy")
             
             if len(chunks) == 0:
                 return jsonify({'error': 'No valid text chunks found'}), 400
             
-            # Generate audio for each chunk
+            # Generate audio for all chunks concurrently, keeping chunk order
             audio_segments = []
-            for i, chunk in enumerate(chunks):
-                logger.info(f"Processing chunk {i+1}/{len(chunks)}: '{chunk[:30]}...'")
-                try:
-                    audio_segment = generate_sentence_audio(chunk, voice)
-                    audio_segments.append(audio_segment)
-                except Exception as e:
-                    logger.error(f"Failed to generate audio for chunk {i+1}: {e}")
-                    return jsonify({'error': f'Failed to generate audio for chunk {i+1}: {str(e)}'}), 500
+            with ThreadPoolExecutor(max_workers=min(len(chunks), MAX_INFERENCE_WORKERS)) as executor:
+                futures = []
+                for i, chunk in enumerate(chunks):
+                    logger.info(f"Processing chunk {i+1}/{len(chunks)}: '{chunk[:30]}...'")
+                    futures.append(executor.submit(generate_sentence_audio, chunk, voice))
+                
+                for i, future in enumerate(futures):
+                    try:
+                        audio_segments.append(future.result())
+                    except Exception as e:
+                        logger.error(f"Failed to generate audio for chunk {i+1}: {e}")
+                        for pending in futures[i+1:]:
+                            pending.cancel()
+                        return jsonify({'error': f'Failed to generate audio for chunk {i+1}: {str(e)}'}), 500
             
             # Combine all audio segments using the specified method
             logger.info("Combining audio segments...")
@@ -337,42 +526,48 @@ def generate_audio():
             combined_audio = generate_sentence_audio(text, voice)
             # combined_audio = normalize_audio(combined_audio)
         
-        # Create output buffer
-        output_buffer = io.BytesIO()
-        
         if output_format == 'wav':
-            # Export as WAV with high quality
-            sf.write(output_buffer, combined_audio, 24000, subtype='PCM_16', format='WAV')
-            mimetype = 'audio/wav'
-            extension = 'wav'
-        elif output_format == 'mp4':
+            # Export as WAV; 32-bit float skips the PCM_16 conversion pass
+            subtype = 'PCM_16' if bits == 16 else 'FLOAT'
+            return send_file(
+                encode_wav(combined_audio, subtype=subtype),
+                mimetype='audio/wav',
+                as_attachment=True,
+                download_name=f'generated_audio_{voice}.wav'
+            )
+        
+        if output_format == 'mp4':
             # Convert to mp4
-            with tempfile.NamedTemporaryFile(suffix='.wav', delete=False) as temp_wav:
-                sf.write(temp_wav.name, combined_audio, 24000)
-                audio_segment = AudioSegment.from_wav(temp_wav.name)
-                audio_segment.export(output_buffer, format='mp4', bitrate='128k')
-                os.unlink(temp_wav.name)
+            output_args = MP4_OUTPUT_ARGS
             mimetype = 'audio/mp4'
             extension = 'mp4'
         else:  # mp3
             # Convert to MP3 with high quality settings
-            with tempfile.NamedTemporaryFile(suffix='.wav', delete=False) as temp_wav:
-                sf.write(temp_wav.name, combined_audio, 24000)
-                audio_segment = AudioSegment.from_wav(temp_wav.name)
-                audio_segment.export(output_buffer, format='mp3', bitrate='192k', parameters=['-q:a', '0'])
-                os.unlink(temp_wav.name)
+            output_args = MP3_OUTPUT_ARGS
             mimetype = 'audio/mpeg'
             extension = 'mp3'
         
-        # Reset buffer position
-        output_buffer.seek(0)
+        # Pull the first chunk before responding so encoder failures still return a 500
+        audio_stream = stream_with_ffmpeg(combined_audio, output_args)
+        first_chunk = next(audio_stream, b'')
+        
+        def stream_audio():
+            try:
+                yield first_chunk
+                yield from audio_stream
+            except Exception as e:
+                # Headers are already sent, so re-raise to abort the connection;
+                # the client then sees an incomplete read, not a successful download
+                logger.error(f"Error streaming audio: {e}")
+                raise
+            finally:
+                audio_stream.close()
         
-        # Return audio file
-        return send_file(
-            output_buffer,
+        # Stream the encoded audio as ffmpeg produces it
+        return Response(
+            stream_with_context(stream_audio()),
             mimetype=mimetype,
-            as_attachment=True,
-            download_name=f'generated_audio_{voice}.{extension}'
+            headers={'Content-Disposition': f'attachment; filename=generated_audio_{voice}.{extension}'}
         )
     
     except Exception as e:
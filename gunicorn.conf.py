@@ -0,0 +1,21 @@
+"""
+Gunicorn configuration for the TTS API Gateway
+
+TTS inference is CPU-bound and the ONNX runtime releases the GIL, so we use
+threaded sync workers rather than gevent. Each worker loads its own copy of
+the model, so keep the worker count small and scale with threads instead.
+"""
+
+import os
+
+bind = "0.0.0.0:5050"
+worker_class = "gthread"
+workers = int(os.environ.get("GUNICORN_WORKERS", 2))
+threads = int(os.environ.get("GUNICORN_THREADS", 4))
+
+# Long texts can take a while to synthesize and encode
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 120))
+graceful_timeout = 30
+
+accesslog = "-"
+errorlog = "-"
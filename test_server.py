@@ -3,143 +3,463 @@
 Test script for the TTS API Gateway
 """
 
+import argparse
+from array import array
+import base64
+import hashlib
+import os
+import shutil
+import tempfile
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
+import io
 import json
+import logging
+import statistics
+import sys
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+
+# orjson decodes and encodes noticeably faster when this script is looped for
+# load testing; fall back to the standard library when it isn't installed
+try:
+    import orjson
+    
+    loads = orjson.loads
+    dumps = orjson.dumps
+except ImportError:
+    def loads(content):
+        return json.loads(content)
+    
+    def dumps(obj):
+        return json.dumps(obj).encode()
 
 BASE_URL = "http://localhost:5050"
+HEALTH_URL = f"{BASE_URL}/health"
+VOICES_URL = f"{BASE_URL}/voices"
+GENERATE_URL = f"{BASE_URL}/generate"
+GENERATE_BATCH_URL = f"{BASE_URL}/generate/batch"
+
+# Generated audio is cached here, keyed by a hash of (voice, text)
+CACHE_DIR = "cache"
+
+# Static error-handling payloads, serialized once
+JSON_HEADERS = {"Content-Type": "application/json"}
+MISSING_TEXT_BODY = dumps({"voice": "expr-voice-2-f"})
+EMPTY_TEXT_BODY = dumps({"text": "", "voice": "expr-voice-2-f"})
+
+# Audio generation cases shared by the per-item and batched tests
+GENERATE_TEST_CASES = [
+    {
+        "text": "Hello, this is a test of the text-to-speech system.",
+        "voice": "expr-voice-2-f"
+    },
+    {
+        "text": "This is a longer test message to see how the system handles more text.",
+        "voice": "expr-voice-3-m"
+    }
+]
+
+# Retry transient gateway errors and failed connections with exponential backoff.
+# Read errors are not retried, so a slow or hung POST surfaces once as a ReadTimeout
+# instead of being re-sent to the server.
+RETRY = Retry(
+    total=3,
+    read=False,
+    backoff_factor=0.2,
+    status_forcelist=(502, 503, 504),
+    allowed_methods=frozenset(["GET", "POST"]),
+    raise_on_status=False  # Hand the last response back so tests can report it
+)
+
+class BufferedStreamHandler(logging.StreamHandler):
+    """StreamHandler that leaves flushing to the caller instead of flushing every record"""
+    
+    def flush(self):
+        pass
+
+# Output goes through a logger with a 64 KiB buffer that is only flushed when
+# it fills or at the end of main(), so stdout writes stay out of the timed request paths
+logger = logging.getLogger("tts_test")
+logger.setLevel(logging.INFO)
+logger.propagate = False
+handler = BufferedStreamHandler(io.TextIOWrapper(
+    io.BufferedWriter(io.FileIO(sys.stdout.fileno(), "w", closefd=False), buffer_size=64 * 1024),
+    encoding="utf-8"
+))
+handler.setFormatter(logging.Formatter("%(message)s"))
+logger.addHandler(handler)
+
+# (label, seconds) for every request made during the run
+TIMINGS = []
+
+# Shared session so every test reuses pooled keep-alive connections
+# (pool_maxsize must cover the number of concurrent requests)
+SESSION = requests.Session()
+SESSION.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=RETRY))
+
+# /voices response, fetched once per run by get_voices(). test_voices and
+# test_error_handling run concurrently and both call it, hence the lock.
+_VOICES_CACHE = None
+_VOICES_LOCK = threading.Lock()
+
+def _timed(label, send, *args, **kwargs):
+    """Send a request and record how long it took to return
+    
+    For stream=True calls this is the time to the response headers; otherwise
+    it includes downloading the body.
+    """
+    start = time.perf_counter()
+    response = send(*args, **kwargs)
+    TIMINGS.append((label, time.perf_counter() - start))
+    return response
 
 def test_health():
     """Test the health endpoint"""
-    print("Testing health endpoint...")
+    logger.info("Testing health endpoint...")
     try:
-        response = requests.get(f"{BASE_URL}/health")
+        response = _timed("GET /health", SESSION.get, HEALTH_URL)
         if response.status_code == 200:
-            data = response.json()
-            print(f"✅ Health check passed: {data}")
+            data = loads(response.content)
+            logger.info(f"✅ Health check passed: {data}")
             return data.get('model_loaded', False)
         else:
-            print(f"❌ Health check failed: {response.status_code}")
+            logger.info(f"❌ Health check failed: {response.status_code}")
             return False
     except requests.exceptions.ConnectionError:
-        print("❌ Could not connect to server. Make sure it's running on localhost:5050")
+        logger.info("❌ Could not connect to server. Make sure it's running on localhost:5050")
         return False
 
-def test_voices():
+def get_voices(session):
+    """Fetch the /voices response once and return the cached copy afterwards"""
+    global _VOICES_CACHE
+    with _VOICES_LOCK:
+        if _VOICES_CACHE is None:
+            response = _timed("GET /voices", session.get, VOICES_URL)
+            response.raise_for_status()
+            _VOICES_CACHE = loads(response.content)
+        return _VOICES_CACHE
+
+def test_voices(log=logger.info):
     """Test the voices endpoint"""
-    print("\nTesting voices endpoint...")
+    log("\nTesting voices endpoint...")
     try:
-        response = requests.get(f"{BASE_URL}/voices")
-        if response.status_code == 200:
-            data = response.json()
-            print(f"✅ Voices endpoint: {data['count']} voices available")
-            print(f"Available voices: {data['voices']}")
-            return True
-        else:
-            print(f"❌ Voices endpoint failed: {response.status_code}")
-            return False
+        data = get_voices(SESSION)
+        log(f"✅ Voices endpoint: {data['count']} voices available")
+        log(f"Available voices: {data['voices']}")
+        return True
+    except requests.exceptions.HTTPError as e:
+        log(f"❌ Voices endpoint failed: {e.response.status_code}")
+        return False
     except Exception as e:
-        print(f"❌ Voices endpoint error: {e}")
+        log(f"❌ Voices endpoint error: {e}")
         return False
 
-def test_generate_audio():
-    """Test the audio generation endpoint"""
-    print("\nTesting audio generation...")
-    
-    test_cases = [
-        {
-            "text": "Hello, this is a test of the text-to-speech system.",
-            "voice": "expr-voice-2-f"
-        },
-        {
-            "text": "This is a longer test message to see how the system handles more text.",
-            "voice": "expr-voice-3-m"
-        }
+def _write_all(fd, data):
+    """Write bytes straight to a file descriptor, bypassing Python's buffered IO"""
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+def _cache_path(test_case):
+    """Path of the cached audio for a (voice, text) pair"""
+    key = hashlib.sha256(f"{test_case['voice']}\0{test_case['text']}".encode()).hexdigest()
+    return os.path.join(CACHE_DIR, f"{key}.aac")
+
+def _run_case(i, test_case, session, refresh=False):
+    """Run a single audio generation case, returning its report lines"""
+    lines = [
+        f"\nTest case {i}:",
+        f"Text: '{test_case['text']}'",
+        f"Voice: {test_case['voice']}",
     ]
+    filename = f"test_output_{i}_{test_case['voice']}.aac"
+    cache_path = _cache_path(test_case)
     
-    for i, test_case in enumerate(test_cases, 1):
-        print(f"\nTest case {i}:")
-        print(f"Text: '{test_case['text']}'")
-        print(f"Voice: {test_case['voice']}")
-        
-        try:
-            response = requests.post(
-                f"{BASE_URL}/generate",
-                json=test_case,
-                timeout=30  # 30 second timeout for audio generation
-            )
-            
+    # Reuse audio generated by a previous run for the same input
+    if not refresh and os.path.exists(cache_path):
+        shutil.copyfile(cache_path, filename)
+        lines.append(f"✅ Audio loaded from cache: {filename}")
+        lines.append(f"   File size: {os.path.getsize(filename)} bytes")
+        return lines
+    
+    try:
+        with _timed(
+            f"POST /generate (case {i})",
+            session.post,
+            GENERATE_URL,
+            data=dumps(test_case),
+            headers=JSON_HEADERS,
+            timeout=30,  # 30 second timeout for audio generation
+            stream=True
+        ) as response:
             if response.status_code == 200:
-                # Save the audio file
-                filename = f"test_output_{i}_{test_case['voice']}.aac"
-                with open(filename, 'wb') as f:
-                    f.write(response.content)
-                print(f"✅ Audio generated successfully: {filename}")
-                print(f"   File size: {len(response.content)} bytes")
+                # Stream the audio into the cache atomically, then copy it out
+                os.makedirs(CACHE_DIR, exist_ok=True)
+                fd, temp_path = tempfile.mkstemp(dir=CACHE_DIR, suffix=".tmp")
+                try:
+                    total = 0
+                    try:
+                        for chunk in response.iter_content(chunk_size=64 * 1024):
+                            _write_all(fd, chunk)
+                            total += len(chunk)
+                    finally:
+                        os.close(fd)
+                    # mkstemp creates files as 0600; give cached audio normal file permissions
+                    os.chmod(temp_path, 0o644)
+                    os.replace(temp_path, cache_path)
+                except BaseException:
+                    os.unlink(temp_path)
+                    raise
+                shutil.copyfile(cache_path, filename)
+                lines.append(f"✅ Audio generated successfully: {filename}")
+                lines.append(f"   File size: {total} bytes")
             else:
-                print(f"❌ Audio generation failed: {response.status_code}")
+                lines.append(f"❌ Audio generation failed: {response.status_code}")
                 try:
-                    error_data = response.json()
-                    print(f"   Error: {error_data.get('error', 'Unknown error')}")
+                    error_data = loads(response.content)
+                    lines.append(f"   Error: {error_data.get('error', 'Unknown error')}")
                 except:
-                    print(f"   Response: {response.text}")
-                    
-        except requests.exceptions.Timeout:
-            print("❌ Request timed out")
-        except Exception as e:
-            print(f"❌ Error: {e}")
-
-def test_error_handling():
+                    lines.append(f"   Response: {response.text}")
+                
+    except requests.exceptions.Timeout:
+        lines.append("❌ Request timed out")
+    except Exception as e:
+        lines.append(f"❌ Error: {e}")
+    
+    return lines
+
+def test_generate_audio(log=logger.info, refresh=False):
+    """Test the audio generation endpoint"""
+    log("\nTesting audio generation...")
+    
+    test_cases = GENERATE_TEST_CASES
+    
+    # Run the cases concurrently so their server-side latencies overlap
+    with ThreadPoolExecutor(max_workers=len(test_cases)) as executor:
+        results = list(executor.map(lambda case: _run_case(*case, SESSION, refresh), enumerate(test_cases, 1)))
+    
+    for lines in results:
+        log("\n".join(lines))
+
+def test_generate_audio_batched(log=logger.info):
+    """Test the batched audio generation endpoint
+    
+    Returns False if the server has no batch endpoint, so the caller can
+    fall back to one request per item.
+    """
+    log("\nTesting batched audio generation...")
+    
+    try:
+        response = _timed(
+            "POST /generate/batch",
+            SESSION.post,
+            GENERATE_BATCH_URL,
+            data=dumps({"batch": GENERATE_TEST_CASES}),
+            headers=JSON_HEADERS,
+            timeout=60  # Covers generation of every item in the batch
+        )
+    except requests.exceptions.Timeout:
+        log("❌ Request timed out")
+        return True
+    except Exception as e:
+        log(f"❌ Error: {e}")
+        return True
+    
+    if response.status_code == 404:
+        log("⏭️  Batch endpoint not available, falling back to per-item requests")
+        return False
+    
+    if response.status_code != 200:
+        log(f"❌ Batched audio generation failed: {response.status_code}")
+        return True
+    
+    # The batch endpoint returns a JSON array of base64-encoded audio payloads
+    try:
+        payloads = loads(response.content)
+    except ValueError as e:
+        log(f"❌ Could not decode batch response: {e}")
+        return True
+    
+    if not isinstance(payloads, list):
+        log(f"❌ Expected a JSON array of audio payloads, got {type(payloads).__name__}")
+        return True
+    
+    if len(payloads) != len(GENERATE_TEST_CASES):
+        log(f"❌ Expected {len(GENERATE_TEST_CASES)} audio payloads, got {len(payloads)}")
+        return True
+    
+    for i, (test_case, payload) in enumerate(zip(GENERATE_TEST_CASES, payloads), 1):
+        filename = f"test_output_{i}_{test_case['voice']}.aac"
+        try:
+            audio = base64.b64decode(payload, validate=True)
+            fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            try:
+                _write_all(fd, audio)
+            finally:
+                os.close(fd)
+        except (TypeError, ValueError, OSError) as e:
+            log(f"❌ Could not save audio payload {i}: {e}")
+            continue
+        log(f"✅ Audio generated successfully: {filename}")
+        log(f"   File size: {len(audio)} bytes")
+    
+    return True
+
+def test_error_handling(log=logger.info):
     """Test error handling"""
-    print("\nTesting error handling...")
+    log("\nTesting error handling...")
     
-    # Test missing text
-    print("Testing missing text...")
-    response = requests.post(f"{BASE_URL}/generate", json={"voice": "expr-voice-2-f"})
-    if response.status_code == 400:
-        print("✅ Correctly handled missing text")
-    else:
-        print(f"❌ Unexpected response for missing text: {response.status_code}")
+    # Invalid voice is derived from a real voice name when the list is available
+    try:
+        invalid_voice = f"{get_voices(SESSION)['voices'][0]}-nope"
+    except Exception:
+        invalid_voice = "invalid-voice"
     
-    # Test invalid voice
-    print("Testing invalid voice...")
-    response = requests.post(f"{BASE_URL}/generate", json={"text": "test", "voice": "invalid-voice"})
-    if response.status_code == 400:
-        print("✅ Correctly handled invalid voice")
-    else:
-        print(f"❌ Unexpected response for invalid voice: {response.status_code}")
+    cases = [
+        ("missing text", MISSING_TEXT_BODY),
+        ("invalid voice", dumps({"text": "test", "voice": invalid_voice})),
+        ("empty text", EMPTY_TEXT_BODY),
+    ]
     
-    # Test empty text
-    print("Testing empty text...")
-    response = requests.post(f"{BASE_URL}/generate", json={"text": "", "voice": "expr-voice-2-f"})
-    if response.status_code == 400:
-        print("✅ Correctly handled empty text")
-    else:
-        print(f"❌ Unexpected response for empty text: {response.status_code}")
+    def probe(name, body):
+        with _timed(f"POST /generate ({name})", SESSION.post, GENERATE_URL,
+                    data=body, headers=JSON_HEADERS, stream=True) as response:
+            if response.status_code == 400:
+                # Passing case: discard the small error body unparsed so the
+                # keep-alive connection can go back to the pool
+                response.raw.drain_conn()
+                return name, response.status_code, None
+            
+            # Only decode the body when it's needed to report a failure
+            try:
+                detail = loads(response.content).get('error', 'Unknown error')
+            except Exception:
+                detail = response.text[:200]
+            return name, response.status_code, detail
+    
+    # The probes are independent, so send them concurrently
+    with ThreadPoolExecutor(max_workers=len(cases)) as executor:
+        results = list(executor.map(lambda case: probe(*case), cases))
+    
+    for name, status_code, detail in results:
+        log(f"Testing {name}...")
+        if status_code == 400:
+            log(f"✅ Correctly handled {name}")
+        else:
+            log(f"❌ Unexpected response for {name}: {status_code}")
+            log(f"   Response: {detail}")
 
-def main():
-    """Run all tests"""
-    print("🚀 Starting TTS API Gateway tests...")
-    print("=" * 50)
+def run_load_test(total, concurrency):
+    """Send `total` /generate requests with `concurrency` in flight and report latency percentiles"""
+    logger.info(f"🏋️  Load test: {total} requests, {concurrency} in flight")
+    
+    # Every worker needs its own pooled keep-alive connection. Retries are disabled so
+    # each failure is counted once and latencies are not inflated by backoff or re-sends.
+    SESSION.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=max(16, concurrency), max_retries=0))
     
-    # Test health first
-    model_loaded = test_health()
+    bodies = [dumps(test_case) for test_case in GENERATE_TEST_CASES]
+    latencies = array('d', [0.0]) * total
     
-    if not model_loaded:
-        print("\n⚠️  Model not loaded. Some tests may fail.")
+    def one_request(index):
+        start = time.perf_counter()
+        try:
+            with SESSION.post(GENERATE_URL, data=bodies[index % len(bodies)],
+                              headers=JSON_HEADERS, timeout=30) as response:
+                status_code = response.status_code
+        except requests.exceptions.RequestException:
+            status_code = None
+        latencies[index] = time.perf_counter() - start
+        return status_code
     
-    # Test other endpoints
-    test_voices()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        status_codes = list(executor.map(one_request, range(total)))
+    elapsed = time.perf_counter() - start
     
-    if model_loaded:
-        test_generate_audio()
+    # Failed requests (connection errors, fast 4xx/5xx) would skew the percentiles,
+    # so latencies are reported for successful requests only
+    successes = [latency for latency, status_code in zip(latencies, status_codes) if status_code == 200]
+    failures = total - len(successes)
+    logger.info(f"   Completed in {elapsed:.2f}s ({total / elapsed:.2f} req/s), {failures} failed")
+    if not successes:
+        logger.info("   ❌ No successful requests, no latency percentiles to report")
+        return
+    if len(successes) > 1:
+        percentiles = statistics.quantiles(successes, n=100)
+        p50, p95, p99 = percentiles[49], percentiles[94], percentiles[98]
     else:
-        print("\n⏭️  Skipping audio generation test (model not loaded)")
+        p50 = p95 = p99 = successes[0]
+    logger.info(f"   Latency of {len(successes)} successful requests "
+                f"p50: {p50 * 1000:.1f} ms  p95: {p95 * 1000:.1f} ms  p99: {p99 * 1000:.1f} ms")
+
+def positive_int(value):
+    """argparse type for integers of at least 1"""
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid int value: {value!r}")
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {number}")
+    return number
+
+def main():
+    """Run all tests"""
+    parser = argparse.ArgumentParser(description="Test the TTS API Gateway")
+    parser.add_argument("--refresh", action="store_true",
+                        help="ignore cached audio and regenerate it")
+    parser.add_argument("--load", type=positive_int, metavar="N",
+                        help="benchmark mode: send N /generate requests and report latency percentiles")
+    parser.add_argument("--concurrency", type=positive_int, default=4, metavar="C",
+                        help="requests in flight in benchmark mode (default: 4)")
+    args = parser.parse_args()
+    
+    if args.load is not None:
+        try:
+            with SESSION:
+                run_load_test(args.load, args.concurrency)
+        finally:
+            handler.stream.flush()
+        return
     
-    test_error_handling()
+    logger.info("🚀 Starting TTS API Gateway tests...")
+    logger.info("=" * 50)
     
-    print("\n" + "=" * 50)
-    print("🏁 Tests completed!")
+    try:
+        with SESSION:
+            # Test health first
+            model_loaded = test_health()
+            
+            if not model_loaded:
+                logger.info("\n⚠️  Model not loaded. Some tests may fail.")
+            
+            def test_generation(log):
+                if not model_loaded:
+                    log("\n⏭️  Skipping audio generation test (model not loaded)")
+                # Prefer a single batched request; older servers only support per-item calls
+                elif not test_generate_audio_batched(log):
+                    test_generate_audio(log, refresh=args.refresh)
+            
+            # The remaining tests are independent, so run them concurrently and
+            # log each one's report in order once it finishes
+            tests = [test_voices, test_generation, test_error_handling]
+            reports = [[] for _ in tests]
+            with ThreadPoolExecutor(max_workers=len(tests)) as executor:
+                futures = [executor.submit(test, report.append) for test, report in zip(tests, reports)]
+                for future, report in zip(futures, reports):
+                    future.result()
+                    logger.info("\n".join(report))
+
+        logger.info("\n" + "=" * 50)
+        logger.info("🏁 Tests completed!")
+        
+        logger.info("\n⏱️  Request timings:")
+        for label, seconds in TIMINGS:
+            logger.info(f"   {label:<40} {seconds * 1000:8.1f} ms")
+    finally:
+        handler.stream.flush()
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
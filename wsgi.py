@@ -0,0 +1,5 @@
+"""
+WSGI entry point for running the TTS API Gateway under gunicorn
+"""
+
+from app import app